@@ -37,16 +37,20 @@ Implementation of Gherkin steps::
 from __future__ import annotations
 
 from collections.abc import ByteString
+from dataclasses import dataclass
+from functools import lru_cache
+import itertools
 from pathlib import Path
 import random
 import re
 import subprocess
+import sys
 import time
 from typing import Any, AnyStr, Callable, Iterable, Iterator, NamedTuple, Optional, Protocol, TypeVar, Union, Tuple
 
 import gi
 gi.require_version('Atspi', '2.0')
-from gi.repository import Atspi
+from gi.repository import Atspi, GLib
 
 __all__ = [
     'perform_on',
@@ -61,6 +65,7 @@ __all__ = [
     'fail_on_error',
     'Either',
     'MatchArgs',
+    'Regex',
 ]
 
 
@@ -168,6 +173,10 @@ def obj_get_attr(obj: Atspi.Object, name:str) -> Either[str]:
     elif name == 'name':
         return getattr(obj, 'name') or ""
     elif name == 'text':
+        # Avoid the call, and its error, on objects without text. The
+        # message doesn't describe the object, it'd cost two more calls.
+        if 'Text' not in obj.get_interfaces():
+            return AttributeError("object doesn't implement the Text interface")
         return obj.get_text(0, -1)
     elif hasattr(obj, name):
         return getattr(obj, name)
@@ -194,15 +203,45 @@ def obj_get_attr(obj: Atspi.Object, name:str) -> Either[str]:
 #
 # TODO: decidir si implementar la primera opción.
 # TODO: añadir más casos a la función
+_ROLE_NAMES = frozenset(k for k in Atspi.Role.__dict__ if k.isupper())
+
+
+def _role_id(role_name: str) -> Optional[Atspi.Role]:
+    role_id = getattr(Atspi.Role, role_name.upper().replace(' ', '_'), None)
+    # Only when it is the same role the object would report by name
+    if role_id is None or Atspi.role_get_name(role_id) != role_name:
+        return None
+    return role_id
+
+
 def _help_not_found(kwargs) -> str:
     msg = ""
     role = kwargs.get('role', None)
-    if role and role.upper() not in Atspi.Role.__dict__:
+    if type(role) == str and role.upper().replace(' ', '_') not in _ROLE_NAMES:
         msg = f"{msg}\n{role} is not a role name"
     return msg
 
 
+class Regex(str):
+    """A string that must be interpreted as a regular expression.
+
+    It allows to write patterns without compiling them::
+
+        shows(role= "label", text= Regex(r"Has pulsado \\d+ veces"))
+
+    The compiled regular expressions are cached, so using the same
+    pattern again doesn't compile it again.
+
+    """
+
+
+@lru_cache(maxsize=512)
+def _compiled(pattern: str) -> re.Pattern:
+    return re.compile(pattern)
+
+
 MatchPattern = Union[AnyStr,
+                     Regex,
                      re.Pattern,
                      Callable[[Atspi.Object],bool],
                      Callable[[Any],bool]]
@@ -241,7 +280,7 @@ Each pair ``name: value`` is interpreted as follows:
                 The value must equal to the value of the object's
                 attribute.
 
-            **value = re.Pattern:** A regular expression.
+            **value = re.Pattern | Regex:** A regular expression.
 
                 The object's attribute value must match the given re.
 
@@ -252,47 +291,201 @@ Each pair ``name: value`` is interpreted as follows:
 
 """
 
+_Predicate = Callable[[Atspi.Object, Optional['_LazyPath']], bool]
+
+
+# Los patrones no cambian durante una búsqueda, así que los
+# convertimos en funciones una sola vez, en lugar de volver a
+# decidir qué hacer con cada patrón en cada nodo.
+#
 # TODO: Parámetro `path` el valor puede incluir patrones. Hay que ver
 # qué lenguaje usamos. Tiene que machear con el path desde el root
 # hasta el widget.  ¿ Nos interesa incluir otros atributos además de
 # la posición dentro de los siblings ?
-def _match(obj: Atspi.Object, path: TreePath, name: str, value: Any) -> bool:
+def _compile_pattern(name: str, value: Any) -> _Predicate:
     if name == 'path':
         TODO
         
     elif name == 'nth':
-        nth_of = path[-1]
-        idx = value if value >= 0 else nth_of.n + value
-        return idx == nth_of.i
+        if value >= 0:
+            return lambda obj, path: path.last.i == value
+        def nth_from_end(obj: Atspi.Object, path: _LazyPath) -> bool:
+            nth_of = path.last
+            return nth_of.n + value == nth_of.i
+        return nth_from_end
     
     elif name == 'when':
-        return value(obj, path)
+        # The user's predicate gets an actual tuple
+        return lambda obj, path: value(obj, path.as_tuple())
     
     # From now on, the name is the name of an object's attribute
-    elif type(value) == str or isinstance(value, ByteString):
-        return obj_get_attr(obj, name) == value
-    
-    elif type(value) == re.Pattern:
-        attr_value = obj_get_attr(obj, name)
-        if is_error(attr_value):
-            return False
-        return value.fullmatch(attr_value) is not None
+    if name == 'role' and type(value) == str:
+        role_id = _role_id(value)
+        if role_id is not None:
+            # Comparing the enum avoids fetching the role name
+            return lambda obj, path: obj.get_role() == role_id
+
+    compile_attr_pattern = _ATTR_PATTERN_COMPILERS.get(type(value))
+    if compile_attr_pattern is not None:
+        return compile_attr_pattern(name, value)
+
+    elif isinstance(value, Regex):
+        return _compile_regex_pattern(name, value)
+
+    elif isinstance(value, (str, ByteString)):
+        return _compile_eq_pattern(name, value)
     
     elif callable(value):
-        return value(obj_get_attr(obj, name))
+        return lambda obj, path: value(obj_get_attr(obj, name))
     
     # It looks like an error
     else:
         TODO
 
 
+def _compile_eq_pattern(name: str, value: AnyStr) -> _Predicate:
+    return lambda obj, path: obj_get_attr(obj, name) == value
+
+
+def _compile_re_pattern(name: str, regex: re.Pattern) -> _Predicate:
+    fullmatch = regex.fullmatch
+    def match(obj: Atspi.Object, path: Optional[_LazyPath]) -> bool:
+        attr_value = obj_get_attr(obj, name)
+        if isinstance(attr_value, Exception):
+            return False
+        return fullmatch(attr_value) is not None
+    return match
+
+
+def _compile_regex_pattern(name: str, value: Regex) -> _Predicate:
+    return _compile_re_pattern(name, _compiled(value))
+
+
+# Patrones sobre atributos, según el tipo del valor. Los subtipos se
+# resuelven en `_compile_pattern`.
+_ATTR_PATTERN_COMPILERS = {
+    str: _compile_eq_pattern,
+    bytes: _compile_eq_pattern,
+    Regex: _compile_regex_pattern,
+    re.Pattern: _compile_re_pattern,
+}
+
+
+# Coste aproximado de comprobar cada patrón. Los patrones baratos se
+# comprueban antes, así la mayoría de los objetos se descartan sin
+# llegar a los caros (p.e. obtener el texto completo).
+_PATTERN_COST = {'nth': 0, 'role': 1, 'name': 2, 'text': 5, 'when': 9}
+_DEFAULT_PATTERN_COST = 4
+
+
+_Patterns = Tuple[Tuple[str, Any], ...]
+
+
+def _sort_patterns(items: Iterable[tuple[str, Any]]) -> _Patterns:
+    return tuple(sorted(items,
+                        key= lambda item: _PATTERN_COST.get(item[0], _DEFAULT_PATTERN_COST)))
+
+
+# Se llama una vez por nodo, un bucle explícito evita crear un
+# generador cada vez.
+def _match_all(obj: Atspi.Object, path: Optional[_LazyPath], predicates: Iterable[_Predicate]) -> bool:
+    for predicate in predicates:
+        if not predicate(obj, path):
+            return False
+    return True
+
+
+# Patrones que necesitan el path del objeto. Si no aparece ninguno, no
+# hace falta construir los paths durante la búsqueda.
+_PATH_PATTERNS = frozenset(('path', 'nth', 'when'))
+_NO_PATH: Optional[_LazyPath] = None
+
+
+@dataclass(frozen=True)
+class _Query:
+    patterns: _Patterns
+    predicates: Tuple[_Predicate, ...]
+    uses_path: bool
+
+
+def _make_query(items: _Patterns) -> _Query:
+    patterns = _sort_patterns(items)
+    return _Query(patterns= patterns,
+                  predicates= tuple(_compile_pattern(name, value) for name, value in patterns),
+                  uses_path= any(name in _PATH_PATTERNS for name, _value in patterns))
+
+
+# `do` y `shows` suelen repetir las mismas búsquedas, guardamos los
+# predicados ya compilados.
+@lru_cache(maxsize=256)
+def _cached_query(key: Tuple[Tuple[str, type, Any], ...]) -> _Query:
+    return _make_query(tuple((name, value) for name, _type, value in key))
+
+
+def _compile_query(kwargs: MatchArgs) -> _Query:
+    # Functions hash by identity, and the ones written inline in a
+    # step are new objects every time. Caching them would never hit,
+    # and it'd keep them, and whatever they capture, alive.
+    if any(callable(value) for value in kwargs.values()):
+        return _make_query(tuple(kwargs.items()))
+    # The type is part of the key: Regex("a.c") == "a.c", but they
+    # are different patterns.
+    key = tuple((name, type(value), value) for name, value in sorted(kwargs.items()))
+    try:
+        hash(key)
+    except TypeError:
+        # Some value isn't hashable
+        return _make_query(tuple(kwargs.items()))
+    return _cached_query(key)
+
+
+def _collection_matches(root: Atspi.Object, patterns: _Patterns) -> Optional[list[Atspi.Object]]:
+    """Asks the application for the descendants with the given role.
+
+    The application evaluates the role in its own process using the
+    at-spi Collection interface, so the search takes one call instead
+    of one call per node. The remaining patterns must be checked
+    afterwards, and none of them may read the path.
+
+    Returns None when the search cannot be done this way.
+
+    """
+    role = dict(patterns).get('role')
+    if type(role) != str:
+        return None
+    role_id = _role_id(role)
+    if role_id is None:
+        return None
+    try:
+        collection = root.get_collection_iface()
+        if collection is None:
+            return None
+        rule = Atspi.MatchRule.new(Atspi.StateSet.new([]), Atspi.CollectionMatchType.ALL,
+                                   {}, Atspi.CollectionMatchType.ALL,
+                                   [role_id], Atspi.CollectionMatchType.ANY,
+                                   [], Atspi.CollectionMatchType.ALL,
+                                   False)
+        matches = collection.get_matches(rule, Atspi.CollectionSortOrder.CANONICAL, 0, True)
+    except (AttributeError, TypeError, GLib.Error):
+        return None
+    return [obj for obj in matches if obj != root]
+
+
 def _find_all_descendants(root: Atspi.Object, kwargs: MatchArgs) -> Iterable[Atspi.Object]:
     if len(kwargs) == 0:
-        descendants = (obj for _path, obj in tree_walk(root))
+        return _tree_walk_nodes(root)
+    query = _compile_query(kwargs)
+    if query.uses_path:
+        return (obj for path, obj in _tree_walk_lazy_paths(root)
+                if _match_all(obj, path, query.predicates))
+    matches = _collection_matches(root, query.patterns)
+    if matches is None:
+        nodes = _tree_walk_nodes(root)
     else:
-        descendants = (obj for path, obj in tree_walk(root)
-                       if all(_match(obj, path, name, value) for name, value in kwargs.items()))
-    return descendants
+        # The root is part of the search too
+        nodes = itertools.chain((root,), matches)
+    return (obj for obj in nodes
+            if _match_all(obj, _NO_PATH, query.predicates))
 
     
 def find_obj(root: Atspi.Object, **kwargs: MatchArgs) -> Either[Atspi.Object]:
@@ -363,7 +556,7 @@ def find_all_objs(roots: Union[Atspi.Object, Iterable[Atspi.Object]], **kwargs:
     result = []
     if len(kwargs) == 0:
         for root in roots:
-            result.extend(obj for _path, obj in tree_walk(root))
+            result.extend(_tree_walk_nodes(root))
     else:
         for root in roots:
             result.extend(_find_all_descendants(root, kwargs))
@@ -429,11 +622,61 @@ def tree_walk(root: Atspi.Object, path: TreePath= ROOT_TREE_PATH) -> Iterator[Tu
 
     """
     
-    yield path, root
-    children = obj_children(root)
-    n_children = len(children)
-    for i, child in enumerate(children):
-        yield from tree_walk(child, path= path + (NthOf(i,n_children),))
+    # Iterative traversal, a recursive generator would pass every
+    # yielded value through all the enclosing generators.
+    stack = [(path, root)]
+    while stack:
+        path, node = stack.pop()
+        yield path, node
+        children = obj_children(node)
+        n_children = len(children)
+        stack.extend((path + (NthOf(i, n_children),), children[i])
+                     for i in range(n_children - 1, -1, -1))
+
+
+def _tree_walk_nodes(root: Atspi.Object) -> Iterator[Atspi.Object]:
+    """Same traversal as :py:func:`tree_walk`, without the paths."""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(obj_children(node)))
+
+
+class _LazyPath:
+    """A tree path that is only built as a tuple when needed.
+
+    Every path shares its prefix with the path of its parent, so
+    creating one takes constant time, instead of copying the prefix.
+    The last position, the one the `nth` pattern reads, is available
+    right away as `last`.
+
+    """
+    __slots__ = ('parent', 'last')
+
+    def __init__(self, parent: Optional[_LazyPath], last: NthOf) -> None:
+        self.parent = parent
+        self.last = last
+
+    def as_tuple(self) -> TreePath:
+        nths = []
+        path = self
+        while path is not None:
+            nths.append(path.last)
+            path = path.parent
+        return tuple(reversed(nths))
+
+
+def _tree_walk_lazy_paths(root: Atspi.Object) -> Iterator[Tuple[_LazyPath, Atspi.Object]]:
+    """Same traversal as :py:func:`tree_walk`, with lazy paths."""
+    stack = [(_LazyPath(None, ROOT_TREE_PATH[-1]), root)]
+    while stack:
+        path, node = stack.pop()
+        yield path, node
+        children = obj_children(node)
+        n_children = len(children)
+        stack.extend((_LazyPath(path, NthOf(i, n_children)), children[i])
+                     for i in range(n_children - 1, -1, -1))
 
 
 # El nombre de la acción es un parámetro porque hay acciones con
@@ -455,7 +698,7 @@ UIEachShows = Callable[..., Iterator[bool]]
 UIMultipleInteraction = Tuple[UserForeachDo, UIEachShows]
 
 
-def _as_iterable(objs: Obj_S) -> Iterable[Atspi.Object]:
+def _as_iterable(objs: Union[Atspi.Object, Iterable[Atspi.Object]]) -> Iterable[Atspi.Object]:
     return (objs,) if isinstance(objs, Atspi.Object) else objs
     
                
@@ -463,9 +706,15 @@ def _do(obj: Atspi.Object, action_name: str) -> None:
     idx = _get_action_idx(obj, action_name)
     if idx is None:
         names = _get_actions_names(obj)
-        raise NotFoundError(f"widget {_pprint(obj)} has no action named '{name}', got: {','.join(names)}")
+        raise NotFoundError(f"widget {_pprint(obj)} has no action named '{action_name}', got: {','.join(names)}")
     obj.do_action(idx)
 
+
+# Como `find_obj`, pero sin construir el mensaje de error cuando no
+# encuentra nada, eso cuesta más llamadas al at-spi.
+def _shows(root: Atspi.Object, kwargs: MatchArgs) -> bool:
+    return next(_find_all_descendants(root, kwargs), None) is not None
+
     
 def perform_on(root: Atspi.Object, **kwargs: MatchArgs) -> UIInteraction:
     """Constructs functions that interact with one part of the user interface.
@@ -532,7 +781,7 @@ def perform_on(root: Atspi.Object, **kwargs: MatchArgs) -> UIInteraction:
     def shows(**kwargs) -> bool:
         if len(kwargs) == 0:
             raise TypeError("shows must have at least one argument, got 0")
-        return not is_error(find_obj(on_obj, **kwargs))
+        return _shows(on_obj, kwargs)
                    
     return (do, shows)
 
@@ -568,7 +817,9 @@ def perform_on_each(roots: Iterable[Atspi.Object], **kwargs: MatchArgs) -> UIMul
        shown and the at-spi object that contains that information.
 
        Note that the result is an iterator which data can be
-       aggregated using the builtins ``any`` or ``all``.
+       aggregated using the builtins ``any`` or ``all``. Each subtree
+       is only searched when its value is consumed, so ``any`` stops
+       at the first subtree that shows the information.
 
        :param \*\*kwargs: See :py:data:`MatchArgs`
        :return: A collection of booleans indicating whether any object matches the patterns for each root object
@@ -599,7 +850,7 @@ def perform_on_each(roots: Iterable[Atspi.Object], **kwargs: MatchArgs) -> UIMul
     """
 
     on_objs = [ fail_on_error(find_obj(root, **kwargs))
-                for root in roots ]
+                for root in _as_iterable(roots) ]
 
     def do(action_name: str, **kwargs) -> None:
         for on_obj in on_objs:
@@ -609,23 +860,32 @@ def perform_on_each(roots: Iterable[Atspi.Object], **kwargs: MatchArgs) -> UIMul
     def shows(**kwargs) -> Iterator[bool]:
         if len(kwargs) == 0:
             raise TypeError("shows must have at least one argument, got 0")
-        return (not is_error(find_obj(on_obj, **kwargs)) for on_obj in on_objs)
+        return (_shows(on_obj, kwargs) for on_obj in on_objs)
 
     return (do, shows)
 
 
 ###########################################################################
+# Esperas entre comprobaciones: empezamos con esperas cortas, la
+# aplicación suele aparecer enseguida, y las vamos alargando.
+_WAIT_FIRST_DELAY = 0.03
+_WAIT_MAX_DELAY = 0.4
+_WAIT_BACKOFF = 1.6
+
+
 def _wait_for_app(name: str, timeout: Optional[float]= None) -> Optional[Atspi.Object]:
     desktop = Atspi.get_desktop(0)
     start = time.time()
     app = None
     timeout = timeout or 5
+    delay = _WAIT_FIRST_DELAY
     while app is None and (time.time() - start) < timeout:
         gen = (child for child in obj_children(desktop)
                if child and child.get_name() == name)
         app = next(gen, None)
         if app is None:
-            time.sleep(0.6)
+            time.sleep(delay)
+            delay = min(delay * _WAIT_BACKOFF, _WAIT_MAX_DELAY)
     return app
 
 
@@ -691,8 +951,12 @@ def dump_desktop() -> None:
         print(app.get_name())
 
 
-def _draw_branches(path: TreePath) -> str:
-    return f"{draw_1}{draw_2}"
+def _draw_branch(nth_of: NthOf) -> str:
+    return "└ " if nth_of.is_last() else "├ "
+
+
+def _draw_trunk(nth_of: NthOf) -> str:
+    return "  " if nth_of.is_last() else "│ "
 
 
 def dump_app(name: str) -> None:
@@ -715,6 +979,11 @@ def dump_app(name: str) -> None:
         print(f"Try running {__file__} without args to get the list of apps")
         sys.exit(0)
     app = apps[0]
+    # trunks[d] es lo que se dibuja a la izquierda de los hijos de
+    # un nodo a profundidad d. Lo vamos calculando a la vez que el
+    # recorrido en lugar de recalcularlo en cada línea.
+    trunks = [""]
+    lines = []
     for path, node in tree_walk(app):
         interfaces = node.get_interfaces()
         try:
@@ -726,9 +995,12 @@ def dump_app(name: str) -> None:
             pass
         role_name = node.get_role_name()
         name = node.get_name() or ""
-        draw_1 = "".join("  " if nth_of.is_last() else "│ " for nth_of in path[:-1])
-        draw_2 = "└ " if path[-1].is_last() else "├ "
-        print(f"{draw_1}{draw_2}{role_name}({name}) {interfaces}")
+        depth = len(path)
+        del trunks[depth:]
+        trunk = trunks[depth - 1]
+        trunks.append(trunk + _draw_trunk(path[-1]))
+        lines.append(f"{trunk}{_draw_branch(path[-1])}{role_name}({name}) {interfaces}")
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 def main() -> None:
@@ -744,7 +1016,6 @@ def main() -> None:
 
        Dumps the tree of at-spi objects of the application {name}
     """
-    import sys
     
     if len(sys.argv) == 1:
         dump_desktop()
@@ -0,0 +1,140 @@
+import re
+
+import pytest
+
+try:
+    from ipm import e2e
+except (ImportError, ValueError):
+    pytest.skip("at-spi introspection bindings are not available", allow_module_level=True)
+
+from ipm.e2e import NthOf
+
+
+class FakeObject:
+    def __init__(self, name, children=(), role="label", text=None):
+        self.name = name
+        self.children = list(children)
+        self.role = role
+        self.text = text
+
+    def get_name(self):
+        return self.name
+
+    def get_role_name(self):
+        return self.role
+
+    def get_role(self):
+        return getattr(e2e.Atspi.Role, self.role.upper().replace(' ', '_'))
+
+    def get_interfaces(self):
+        return ['Accessible'] if self.text is None else ['Accessible', 'Text']
+
+    def get_text(self, start, end):
+        return self.text
+
+    def get_child_count(self):
+        return len(self.children)
+
+    def get_child_at_index(self, i):
+        return self.children[i]
+
+
+class LoggingObject(FakeObject):
+    """Records which attributes are read, in order."""
+
+    def __init__(self, *args, **kwargs):
+        self.log = []
+        super().__init__(*args, **kwargs)
+
+    @property
+    def name(self):
+        self.log.append('name')
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+
+    # Only used for error messages, not when matching
+    def get_name(self):
+        return self._name
+
+    def get_role(self):
+        self.log.append('role')
+        return super().get_role()
+
+    def get_text(self, start, end):
+        self.log.append('text')
+        return super().get_text(start, end)
+
+
+def _names(objs):
+    return [obj.name for obj in objs]
+
+
+def _tree():
+    return FakeObject("root", [FakeObject("a", [FakeObject("c")]),
+                               FakeObject("b")])
+
+
+def test_tree_walk_order_and_paths():
+    walk = [(path, obj.name) for path, obj in e2e.tree_walk(_tree())]
+    root = (NthOf(0, 1),)
+    assert walk == [(root, "root"),
+                    (root + (NthOf(0, 2),), "a"),
+                    (root + (NthOf(0, 2), NthOf(0, 1)), "c"),
+                    (root + (NthOf(1, 2),), "b")]
+
+
+def test_nth_from_the_end():
+    root = _tree()
+    assert _names(e2e.find_all_objs([root], nth= -1)) == ["root", "c", "b"]
+    assert _names(e2e.find_all_objs([root], nth= -2)) == ["a"]
+    assert e2e.is_error(e2e.find_obj(root, nth= -3))
+
+
+@pytest.mark.parametrize("value, expected", [("a.c", ["a.c"]),
+                                             (e2e.Regex("a.c"), ["a.c", "abc"]),
+                                             (re.compile("a.c"), ["a.c", "abc"]),
+                                             (re.compile("A.C", re.I), ["a.c", "abc"]),
+                                             (e2e.Regex("a"), [])])
+def test_string_and_regex_patterns(value, expected):
+    root = FakeObject("root", [FakeObject("a.c"), FakeObject("abc")])
+    assert _names(e2e.find_all_objs([root], name= value)) == expected
+
+
+@pytest.mark.parametrize("first, second", [("a.c", e2e.Regex("a.c")),
+                                           (e2e.Regex("a.c"), "a.c")])
+def test_query_cache_tells_regex_from_str(first, second):
+    root = FakeObject("root", [FakeObject("a.c"), FakeObject("abc")])
+    expected = {str: ["a.c"], e2e.Regex: ["a.c", "abc"]}
+    e2e._cached_query.cache_clear()
+    assert _names(e2e.find_all_objs([root], name= first)) == expected[type(first)]
+    assert _names(e2e.find_all_objs([root], name= second)) == expected[type(second)]
+
+
+@pytest.mark.parametrize("name, expected_log", [("other", ['role', 'name']),
+                                                ("x", ['role', 'name', 'text', 'when'])])
+def test_cheap_patterns_first(name, expected_log):
+    obj = LoggingObject("x", text= "t")
+
+    def when(obj, path):
+        obj.log.append('when')
+        return True
+
+    e2e.find_obj(obj, when= when, text= "t", name= name, role= "label")
+    assert obj.log == expected_log
+
+
+def test_role_rejects_before_other_patterns():
+    obj = LoggingObject("x", text= "t")
+    e2e.find_obj(obj, text= "t", name= "x", role= "push button")
+    assert obj.log == ['role']
+
+
+def test_search_without_collection_walks_the_tree():
+    root = FakeObject("root", [FakeObject("a", role= "push button"),
+                               FakeObject("b")])
+    assert e2e._collection_matches(root, (('role', 'push button'),)) is None
+    assert _names(e2e.find_all_objs([root], role= "push button")) == ["a"]
+    assert _names(e2e.find_all_objs([root], role= "label")) == ["root", "b"]